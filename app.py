@@ -1,11 +1,20 @@
 import streamlit as st
 import google.generativeai as genai
-from google.api_core.exceptions import ResourceExhausted
+from google.api_core.exceptions import NotFound, PermissionDenied, ResourceExhausted
+import hashlib
+import io
 import json
-import tempfile
-import os
+import threading
 import time
+from typing_extensions import TypedDict
+import orjson
+from PIL import Image, ImageOps, UnidentifiedImageError
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ==========================================
 # 🔧 設定エリア
@@ -24,46 +33,130 @@ except KeyError:
 # ★修正箇所：リストにあった最新のFlashモデルを指定
 MODEL_NAME = 'models/gemini-2.5-flash'
 
+# Geminiのファイル処理待ちの上限（秒）
+PROCESSING_TIMEOUT = 60
+
+# 画像の長辺の上限（px）。OCR精度はこのあたりで頭打ちになる
+MAX_IMAGE_SIZE = 2048
+
+# 日付の基準となるタイムゾーン（ホスティング環境はUTCのことが多い）
+JST = ZoneInfo("Asia/Tokyo")
+
+# Notionで1リクエストに含められるブロック数の上限
+NOTION_MAX_BLOCKS = 100
+
+# Notion APIのレート制限（約3リクエスト/秒）に合わせた送信間隔（秒）
+NOTION_REQUEST_INTERVAL = 1 / 3
+
 # ==========================================
 # 1. Gemini分析関数
 # ==========================================
-@st.cache_data(show_spinner=False)
-def analyze_file(file_path, mime_type):
+class Event(TypedDict):
+    # Geminiの出力スキーマ（1行事分）
+    date: str
+    event: str
+    items: list[str]
+    note: str | None
+
+def shrink_image(file_bytes):
+    # スマホ写真などの大きな画像は、アップロード前に縮小してJPEGに変換する
+    # 読めない画像はそのまま返し、Gemini側のエラー表示に任せる
+    try:
+        img = Image.open(io.BytesIO(file_bytes))
+        if max(img.size) <= MAX_IMAGE_SIZE:
+            return file_bytes
+
+        # 先に縮小してJPEGのdraft読み込みを効かせ、回転・変換は小さい画像で行う
+        img.thumbnail((MAX_IMAGE_SIZE, MAX_IMAGE_SIZE), Image.LANCZOS)
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=85, optimize=True)
+        return buf.getvalue()
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError):
+        return file_bytes
+
+@st.cache_resource
+def get_model():
+    # APIキー設定とモデル生成は一度だけ行い、再実行時は使い回す
     genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel(MODEL_NAME)
+    return genai.GenerativeModel(MODEL_NAME)
+
+def get_or_upload_file(file_bytes, mime_type, content_hash, display_name=None):
+    # 同じ内容のファイルがアップロード済みなら、そのハンドルを再利用する
+    gemini_files = st.session_state.setdefault('gemini_files', {})
+    name = gemini_files.get(content_hash)
+    if name:
+        try:
+            uploaded_file = genai.get_file(name)
+            if uploaded_file.state.name != "FAILED":
+                return uploaded_file
+        except (NotFound, PermissionDenied):
+            # 有効期限切れ（48時間）などで削除済み（403で返ることもある）
+            pass
+
+    # 縮小はアップロードが必要なときだけ行う
+    if mime_type != "application/pdf":
+        file_bytes = shrink_image(file_bytes)
+    uploaded_file = genai.upload_file(
+        path=io.BytesIO(file_bytes), mime_type=mime_type, display_name=display_name
+    )
+    gemini_files[content_hash] = uploaded_file.name
+    return uploaded_file
+
+class AnalysisError(Exception):
+    # Google側の処理失敗など、画面にそのまま表示するエラー
+    pass
+
+# "_" で始まる引数はキャッシュキーから除外し、content_hash でヒット判定する。
+# 失敗時は例外を投げるので、キャッシュされるのは成功した結果だけになる
+@st.cache_data(show_spinner=False)
+def _extract_events(_file_bytes, mime_type, content_hash, _display_name=None):
+    model = get_model()
+
+    # 1. ファイルアップロード
+    uploaded_file = get_or_upload_file(_file_bytes, mime_type, content_hash, _display_name)
+
+    # 2. 処理完了待ち（0.2秒から2秒まで間隔を伸ばしながら確認）
+    delay = 0.2
+    deadline = time.monotonic() + PROCESSING_TIMEOUT
+    while uploaded_file.state.name == "PROCESSING":
+        if time.monotonic() > deadline:
+            raise AnalysisError("Google側の処理がタイムアウトしました。もう一度お試しください。")
+        time.sleep(delay)
+        delay = min(delay * 1.5, 2.0)
+        uploaded_file = genai.get_file(uploaded_file.name)
+
+    if uploaded_file.state.name == "FAILED":
+        raise AnalysisError("Google側で画像処理に失敗しました。")
+
+    # 3. 生成リクエスト
+    prompt = """
+    あなたは優秀な秘書です。このドキュメントからカレンダー登録用データを抽出してください。
     
+    【出力ルール】
+    - JSON形式で出力すること
+    - date: YYYY-MM-DD (年が不明の場合、アップロード日から推測して、適切な年を設定する)
+    - event: 行事名
+    - items: 持ち物リスト（文字列の配列。なければ空配列）
+    - note: 備考（なければnull）
+    """
+
+    response = model.generate_content(
+        [uploaded_file, prompt],
+        generation_config={
+            "response_mime_type": "application/json",
+            "response_schema": list[Event],
+        }
+    )
+    return json.loads(response.text)
+
+def analyze_file(file_bytes, mime_type, content_hash, display_name=None):
     with st.spinner('🤖 Geminiがプリントを読んでいます...'):
         try:
-            # 1. ファイルアップロード
-            uploaded_file = genai.upload_file(path=file_path, mime_type=mime_type)
-            
-            # 2. 処理完了待ち
-            while uploaded_file.state.name == "PROCESSING":
-                time.sleep(1)
-                uploaded_file = genai.get_file(uploaded_file.name)
-
-            if uploaded_file.state.name == "FAILED":
-                st.error("Google側で画像処理に失敗しました。")
-                return None
-
-            # 3. 生成リクエスト
-            prompt = """
-            あなたは優秀な秘書です。このドキュメントからカレンダー登録用データを抽出してください。
-            
-            【出力ルール】
-            - JSON形式で出力すること
-            - date: YYYY-MM-DD (年が不明の場合、アップロード日から推測して、適切な年を設定する)
-            - event: 行事名
-            - items: 持ち物リスト（文字列の配列。なければ空配列）
-            - note: 備考（なければnull）
-            """
-
-            response = model.generate_content(
-                [uploaded_file, prompt],
-                generation_config={"response_mime_type": "application/json"}
-            )
-            return json.loads(response.text)
-
+            return _extract_events(file_bytes, mime_type, content_hash, display_name)
+        except AnalysisError as e:
+            st.error(str(e))
+            return None
         except ResourceExhausted:
             st.error("⚠️ API利用制限（混雑）です。1分ほど待ってから再実行してください。")
             return None
@@ -74,56 +167,208 @@ def analyze_file(file_path, mime_type):
 # ==========================================
 # 2. Notion送信関数
 # ==========================================
-def send_to_notion(data_list):
-    url = "https://api.notion.com/v1/pages"
-    headers = {
+# 全ページ共通の部分はここで一度だけ作り、各payloadから参照する
+_PAGES_URL = "https://api.notion.com/v1/pages"
+_PARENT = {"database_id": DATABASE_ID}
+_TAGS = {"multi_select": [{"name": "学校"}]}
+
+@st.cache_resource
+def notion_session():
+    # 接続を使い回して、リクエストごとのTLSハンドシェイクを省く
+    s = requests.Session()
+    s.headers.update({
         "Authorization": f"Bearer {NOTION_API_KEY}",
         "Content-Type": "application/json",
         "Notion-Version": "2022-06-28"
-    }
+    })
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=4,
+        # POST/PATCHは冪等でないため、未処理が保証される429と接続失敗だけ再試行する
+        # （5xxや読み取りエラーはNotion側で書き込み済みの可能性があり、重複登録になる）
+        max_retries=Retry(
+            total=3,
+            read=0,
+            backoff_factor=0.5,
+            status_forcelist=[429],
+            allowed_methods=None,
+        ),
+    )
+    s.mount("https://", adapter)
+    return s
 
-    success_count = 0
-    status_text = st.empty()
-    progress_bar = st.progress(0)
-    
-    for i, item in enumerate(data_list):
-        status_text.text(f"送信中: {item['event']}...")
-        progress_bar.progress((i + 1) / len(data_list))
+def _normalize_date(value):
+    # Notionが受け付ける形式（YYYY-MM-DD / YYYY-MM-DDTHH:MM:SS）にそろえる。
+    # "2026-1-5" のような桁不足の日付も直す。解釈できなければNone
+    try:
+        return date.fromisoformat(value).isoformat()
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.fromisoformat(value).isoformat()
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date().isoformat()
+    except (TypeError, ValueError):
+        return None
+
+def _valid_events(data_list):
+    # Notionに弾かれる行は送信前に除外し、無駄なリクエストを減らす
+    valid = []
+    for item in data_list:
+        event_date = _normalize_date(item.get('date'))
+        if not item.get('event'):
+            st.warning(f"行事名がないためスキップしました: {item.get('date')}")
+        elif event_date is None:
+            st.warning(f"日付が不正なためスキップしました: {item['event']} ({item.get('date')})")
+        else:
+            valid.append({**item, 'date': event_date})
+    return valid
+
+def _detail_blocks(item):
+    items_text = "、".join(item.get('items', []))
+    note_text = item.get('note') or ""
+    return [
+        {
+            "object": "block",
+            "type": "callout",
+            "callout": {
+                "rich_text": [{"text": {"content": f"持ち物: {items_text}"}}],
+                "icon": {"emoji": "🎒"}
+            }
+        },
+        {
+            "object": "block",
+            "type": "paragraph",
+            "paragraph": {"rich_text": [{"text": {"content": f"備考: {note_text}"}}]}
+        }
+    ]
+
+def _event_blocks(item):
+    # まとめページ用：行事ごとに見出し＋持ち物＋備考
+    return [
+        {
+            "object": "block",
+            "type": "heading_2",
+            "heading_2": {"rich_text": [{"text": {"content": f"{item['date']} {item['event']}"}}]}
+        },
+        *_detail_blocks(item)
+    ]
+
+def _warn_failed(failed):
+    if failed:
+        names = "、".join(f"{item['event']} ({item['date']})" for item in failed)
+        st.warning(f"{len(failed)}件の登録に失敗しました: {names}")
+
+def send_to_notion(data_list):
+    session = notion_session()
+    data_list = _valid_events(data_list)
 
+    payloads = []
+    for item in data_list:
         icon = "🎒" if item.get('items') else "🗓️"
         title_text = f"{icon} {item['event']}"
-        items_text = "、".join(item.get('items', []))
-        note_text = item.get('note') or ""
-        
-        payload = {
-            "parent": {"database_id": DATABASE_ID},
+
+        payloads.append({
+            "parent": _PARENT,
             "properties": {
                 "Name": {"title": [{"text": {"content": title_text}}]},
                 "Date": {"date": {"start": item['date']}},
-                "Tags": {"multi_select": [{"name": "学校"}]},
+                "Tags": _TAGS,
             },
-            "children": [
-                {
-                    "object": "block",
-                    "type": "callout",
-                    "callout": {
-                        "rich_text": [{"text": {"content": f"持ち物: {items_text}"}}],
-                        "icon": {"emoji": "🎒"}
-                    }
-                },
-                {
-                    "object": "block",
-                    "type": "paragraph",
-                    "paragraph": {"rich_text": [{"text": {"content": f"備考: {note_text}"}}]}
-                }
-            ]
-        }
-        res = requests.post(url, headers=headers, data=json.dumps(payload))
+            "children": _detail_blocks(item)
+        })
+
+    status_text = st.empty()
+    progress_bar = st.progress(0)
+    status_text.text(f"送信中: {len(payloads)}件...")
+
+    # 同時送信数は3まで。レート制限はワーカー間で共有する送信間隔で守る
+    pacing_lock = threading.Lock()
+    next_send_at = 0.0
+
+    def _post(payload):
+        nonlocal next_send_at
+        with pacing_lock:
+            now = time.monotonic()
+            wait = next_send_at - now
+            next_send_at = max(now, next_send_at) + NOTION_REQUEST_INTERVAL
+        if wait > 0:
+            time.sleep(wait)
+        # payloadはorjsonでエンコードして data= で送る（Content-Typeはセッションのヘッダーで指定済み）
+        try:
+            return session.post(_PAGES_URL, data=orjson.dumps(payload)).status_code
+        except requests.RequestException:
+            return None
+
+    success_count = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = {executor.submit(_post, payload): item for payload, item in zip(payloads, data_list)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            if future.result() == 200:
+                success_count += 1
+            else:
+                failed.append(futures[future])
+            progress_bar.progress(done / len(payloads))
+
+    status_text.empty()
+    progress_bar.empty()
+    _warn_failed(failed)
+    return success_count
+
+def send_to_notion_bundled(data_list):
+    # 全行事を1ページにまとめて登録する。ブロック数が上限を超える分は追記リクエストで送る
+    data_list = _valid_events(data_list)
+    if not data_list:
+        return 0
+    session = notion_session()
+
+    events_per_request = NOTION_MAX_BLOCKS // len(_event_blocks(data_list[0]))
+    chunks = [data_list[i:i + events_per_request] for i in range(0, len(data_list), events_per_request)]
+    dates = sorted(item['date'] for item in data_list)
+    date_prop = {"start": dates[0]}
+    if dates[-1] != dates[0]:
+        date_prop["end"] = dates[-1]
+
+    payload = {
+        "parent": _PARENT,
+        "properties": {
+            "Name": {"title": [{"text": {"content": f"プリント {datetime.now(JST).date().isoformat()}"}}]},
+            "Date": {"date": date_prop},
+            "Tags": _TAGS,
+        },
+        "children": [block for item in chunks[0] for block in _event_blocks(item)]
+    }
+
+    status_text = st.empty()
+    progress_bar = st.progress(0)
+    status_text.text(f"送信中: {len(data_list)}件（1ページ）...")
+
+    success_count = 0
+    try:
+        res = session.post(_PAGES_URL, data=orjson.dumps(payload))
         if res.status_code == 200:
-            success_count += 1
-            
+            success_count += len(chunks[0])
+            progress_bar.progress(1 / len(chunks))
+            page_id = res.json()["id"]
+            for i, chunk in enumerate(chunks[1:], start=2):
+                res = session.patch(
+                    f"https://api.notion.com/v1/blocks/{page_id}/children",
+                    data=orjson.dumps({"children": [block for item in chunk for block in _event_blocks(item)]})
+                )
+                if res.status_code != 200:
+                    break
+                success_count += len(chunk)
+                progress_bar.progress(i / len(chunks))
+    except requests.RequestException:
+        pass
+
     status_text.empty()
     progress_bar.empty()
+    # チャンクは順番に送るので、成功件数より後ろの行事が未登録
+    _warn_failed(data_list[success_count:])
     return success_count
 
 # ==========================================
@@ -137,23 +382,20 @@ if 'analyzed_data' not in st.session_state:
 uploaded_file = st.file_uploader("写真またはPDFを選択", type=['png', 'jpg', 'jpeg', 'pdf'])
 
 if uploaded_file is not None:
+    # アップロード内容は一度だけ読み込み、プレビューと解析で使い回す
+    raw = uploaded_file.getvalue()
     if uploaded_file.name.lower().endswith(('.png', '.jpg', '.jpeg')):
-        st.image(uploaded_file, caption="プレビュー", width=300)
+        st.image(io.BytesIO(raw), caption="プレビュー", width=300)
 
     if st.button("AI解析開始"):
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{uploaded_file.name.split('.')[-1]}") as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            tmp_path = tmp_file.name
-
-        mime_type = "application/pdf" if uploaded_file.name.endswith(".pdf") else "image/jpeg"
+        mime_type = "application/pdf" if uploaded_file.name.lower().endswith(".pdf") else "image/jpeg"
         
-        result = analyze_file(tmp_path, mime_type)
+        content_hash = hashlib.sha256(raw).hexdigest()
+        result = analyze_file(raw, mime_type, content_hash, uploaded_file.name)
         
         if result:
             st.session_state['analyzed_data'] = result
             st.success("解析成功！内容を確認してください。")
-        
-        os.unlink(tmp_path)
 
 if st.session_state['analyzed_data']:
     st.subheader("解析結果")
@@ -161,8 +403,12 @@ if st.session_state['analyzed_data']:
     
     col1, col2 = st.columns(2)
     with col1:
+        bundle = st.checkbox("まとめて1ページに登録")
         if st.button("🚀 Notionに登録する", type="primary"):
-            count = send_to_notion(edited_data)
+            if bundle:
+                count = send_to_notion_bundled(edited_data)
+            else:
+                count = send_to_notion(edited_data)
             st.balloons()
             st.success(f"{count}件の予定を登録しました！")
             st.session_state['analyzed_data'] = None